@@ -1,30 +1,159 @@
 import asyncio
-from datetime import datetime
+import contextlib
 import logging
-import os
+import logging.handlers
+import queue
+import weakref
 
 import logfire
+import orjson
 from pydantic_ai import Agent, UnexpectedModelBehavior
-from sqlmodel import create_engine, Session, SQLModel
-from telegram import Update
+from sqlalchemy import event, insert
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlmodel import SQLModel
+from telegram import Chat, Update
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 from telegram.constants import ChatAction
 
+try:
+    import uvloop
+except ImportError:  # uvloop doesn't support Windows
+    uvloop = None
+
+from app.config import settings
 from app.models import ConversationTurn, ChatDeps
+from app.recent_turns import RecentTurns
 from app.tools import reply_to_user, get_chat_history
 from app.auth import is_user_authorized
 
 
-BOT_TOKEN = os.environ['TELEGRAM_BOT_TOKEN']
-MODEL_IDENTIFIER = os.environ['MODEL_IDENTIFIER']
-DATABASE_URL = os.environ['DATABASE_URL']
-
-
-logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+# QueueHandler.prepare() still merges args and renders tracebacks on the calling thread; the
+# listener thread applies the line format and does the blocking write to stderr
+_log_queue = queue.SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+log_listener = logging.handlers.QueueListener(_log_queue, _log_stream, respect_handler_level=True)
+log_listener.start()
+logging.root.addHandler(logging.handlers.QueueHandler(_log_queue))
+logging.root.setLevel(logging.INFO)
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
+# Kept byte-identical across runs so providers can reuse their prompt-prefix cache; per-chat
+# context reaches the model only through tool results, never by templating this string
+SYSTEM_PROMPT = (
+    "You are a helpful AI assistant powered by a Telegram bot. "
+    "Use the reply_to_user tool to send your responses via the Telegram app. "
+    "Use get_chat_history to gather context from previous messages. "
+    "Be conversational and helpful."
+)
+
+WRITE_BATCH_SIZE = 64
+WRITE_BATCH_WINDOW = 0.05  # seconds to wait for more turns before committing a batch
+WRITE_QUEUE_SIZE = 1000  # handlers wait for room once this many turns are pending
+SHUTDOWN_RUN_TIMEOUT = 10  # seconds shutdown waits for in-flight message runs
+
+
+# Turns are write-only from here, so insert plain row dicts through Core and skip the ORM unit of work
+_insert_turns = insert(ConversationTurn.__table__)
+
+async def _save_turns(engine: AsyncEngine, rows: list[dict]) -> list[dict]:
+    """Insert rows in one transaction, splitting the batch in halves if that fails. Returns the rows saved."""
+    try:
+        async with engine.begin() as conn:
+            await conn.execute(_insert_turns, rows)
+        return rows
+    except Exception as e:
+        if len(rows) == 1:
+            logger.error(f"Error saving conversation turn for chat {rows[0]['chat_id']}: {e}", exc_info=True)
+            return []
+        # Don't let one bad row take the other chats' turns down with it; halving isolates it
+        # in about 2*log2(WRITE_BATCH_SIZE) inserts instead of one per row
+        logger.warning(f"Error saving {len(rows)} conversation turns, retrying in halves: {e}")
+    mid = len(rows) // 2
+    return await _save_turns(engine, rows[:mid]) + await _save_turns(engine, rows[mid:])
+
+def _log_pool_usage(engine: AsyncEngine) -> None:
+    """Log pool occupancy on every checkout/checkin to spot saturation (DEBUG only)."""
+    pool = engine.sync_engine.pool
+
+    def log_status(*_) -> None:
+        logger.debug(f"DB pool: {pool.status()}")
+
+    event.listen(engine.sync_engine, "checkout", log_status)
+    event.listen(engine.sync_engine, "checkin", log_status)
+
+async def _write_turns(engine: AsyncEngine, queue: asyncio.Queue, recent_turns: RecentTurns) -> None:
+    """Persist queued (row, saved) turns in batches, one transaction per batch, until a None sentinel arrives.
+
+    Each `saved` future is resolved once its batch has been handled, whether or not the write succeeded.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + WRITE_BATCH_WINDOW
+        while len(batch) < WRITE_BATCH_SIZE and batch[-1] is not None:
+            if not queue.empty():
+                # Take what's already queued without setting up a timed wait per item
+                batch.append(queue.get_nowait())
+                continue
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), deadline - loop.time()))
+            except TimeoutError:
+                break
+        stopping = batch[-1] is None
+        if stopping:
+            batch.pop()
+        if batch:
+            rows = await _save_turns(engine, [row for row, _ in batch])
+            try:
+                recent_turns.add(rows)
+            except Exception as e:
+                # The turns are saved; drop the affected chats so reads fall back to the database
+                logger.error(f"Error caching {len(rows)} saved conversation turns: {e}", exc_info=True)
+                recent_turns.forget(row["chat_id"] for row in rows)
+            for _, saved in batch:
+                if not saved.done():
+                    saved.set_result(None)
+        if stopping:
+            return
+
+# One future per message_handler run still in progress, resolved when the run is done
+_active_runs: set[asyncio.Future] = set()
+
+@contextlib.asynccontextmanager
+async def _track_run():
+    run = asyncio.get_running_loop().create_future()
+    _active_runs.add(run)
+    try:
+        yield
+    finally:
+        _active_runs.discard(run)
+        run.set_result(None)
+
+# Weak values: a chat's lock disappears once no handler is holding or waiting on it
+_chat_locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+
+def _chat_lock(chat_id: int) -> asyncio.Lock:
+    lock = _chat_locks.get(chat_id)
+    if lock is None:
+        lock = _chat_locks[chat_id] = asyncio.Lock()
+    return lock
+
+async def _keep_typing(chat: Chat, done: asyncio.Event) -> None:
+    """Keep the typing indicator visible until `done` is set."""
+    while not done.is_set():
+        try:
+            await chat.send_chat_action(ChatAction.TYPING)
+        except Exception:
+            pass  # Ignore typing indicator errors
+        # Telegram shows "typing" for ~5s; refresh just before it lapses unless we're done first
+        try:
+            await asyncio.wait_for(done.wait(), timeout=4.5)
+        except TimeoutError:
+            pass
+
 @is_user_authorized
 async def start(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text("👋 Agent Ready! Send me a message.")
@@ -35,98 +164,122 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
     logger.info(f"Received message from chat_id {update.message.chat_id}: {update.message.text}")
-    deps = ChatDeps(telegram_message=update.message, engine=context.application.bot_data['engine'], assistant_replies=[])
+    deps = ChatDeps(
+        telegram_message=update.message,
+        engine=context.application.bot_data['engine'],
+        recent_turns=context.application.bot_data['recent_turns'],
+        assistant_replies=[]
+    )
     agent = context.application.bot_data['agent']
 
-    logger.info("Starting agent run...")
-    agent_task = asyncio.create_task(agent.run(update.message.text, deps=deps))
-    typing_task = None
-
-    while not agent_task.done():
+    # One run at a time per chat so each message sees the turns before it; other chats are unaffected
+    async with _track_run(), _chat_lock(update.message.chat.id):
+        logger.info("Starting agent run...")
+        # Typing runs alongside the agent until it finishes or reply_to_user sends a reply
+        typing_task = asyncio.create_task(_keep_typing(update.message.chat, deps.typing_done))
         try:
-            # Only create new typing task if none exists or current one finished naturally (not cancelled)
-            if not typing_task or (typing_task.done() and not typing_task.cancelled()):
-                typing_task = deps.typing_task = asyncio.create_task(update.message.chat.send_chat_action(ChatAction.TYPING))
-            # Wait for either bot to finish or typing indicator to need refresh
-            await asyncio.wait(
-                [agent_task, typing_task],
-                return_when=asyncio.FIRST_COMPLETED
-            )
+            await agent.run(update.message.text, deps=deps)
+        except UnexpectedModelBehavior:
+            return # Typically empty model response, expected when agent uses tools to respond
         except Exception as e:
-            logger.error(f"Error: {e}", exc_info=True)
-            if not agent_task.done(): agent_task.cancel()
-            break
-
-    # Cancel typing indicator after agent completes
-    if typing_task and not typing_task.done():
-        typing_task.cancel()
-    
-    # Handle typing task exceptions to prevent unhandled task errors
-    if typing_task and typing_task.done() and not typing_task.cancelled():
-        try:
-            typing_task.result()
-        except Exception:
-            pass  # Ignore typing indicator errors
-    logger.info("Agent run completed")
+            logger.error(f"Error processing message for chat {update.message.chat.id}: {e}", exc_info=True)
+            return
+        finally:
+            deps.typing_done.set()
+            await typing_task
+        logger.info("Agent run completed")
 
-    # Handle bot task result
-    try:
-        # Get result to ensure any exceptions are handled
-        agent_task.result()
-        # Save conversation to database
-        with Session(deps.engine) as session:
-            session.add(ConversationTurn(
-                chat_id=update.message.chat.id,
-                user_message=update.message.text,
-                assistant_replies=deps.assistant_replies,
-                timestamp=datetime.fromtimestamp(update.message.date.timestamp())
-            ))
-            session.commit()
-    except asyncio.CancelledError:
-        await update.message.reply_text("Sorry, there was a connection problem. Please try again.")
-    except UnexpectedModelBehavior:
-        pass # Typically empty model response, expected when agent uses tools to respond
-    except Exception as e:
-        logger.error(f"Error processing message for chat {update.message.chat.id}: {e}", exc_info=True)
+        # Queue conversation for the background writer; the user already has their reply
+        saved = asyncio.get_running_loop().create_future()
+        await context.application.bot_data['turn_queue'].put(({
+            "chat_id": update.message.chat.id,
+            "user_message": update.message.text,
+            "assistant_replies": deps.assistant_replies,
+            "timestamp": update.message.date
+        }, saved))
+        # Keep the chat locked until the turn is committed so the next message's history includes it
+        await saved
 
 async def startup(application):
 
+    # Keep warm connections for concurrent chats; pre-ping replaces ones the server dropped while idle,
+    # and recycling retires connections before proxies/idle timeouts cut them
+    engine = create_async_engine(
+        settings.database_url,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_recycle=1800,
+        pool_pre_ping=True,
+        json_serializer=lambda value: orjson.dumps(value).decode(),
+        json_deserializer=orjson.loads,
+    )
+    if logger.isEnabledFor(logging.DEBUG):
+        _log_pool_usage(engine)
+    if settings.create_tables:
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+
     logfire.configure(send_to_logfire='if-token-present')
     logfire.instrument_pydantic_ai()
-    engine = create_engine(DATABASE_URL)
-    SQLModel.metadata.create_all(engine)
-
-    system_prompt = (
-        "You are a helpful AI assistant powered by a Telegram bot. "
-        "Use the reply_to_user tool to send your responses via the Telegram app. "
-        "Use get_chat_history to gather context from previous messages. "
-        "Be conversational and helpful."
-    )
 
     agent = Agent(
-        MODEL_IDENTIFIER,
+        settings.model_identifier,
         deps_type=ChatDeps,
-        system_prompt=system_prompt,
+        system_prompt=SYSTEM_PROMPT,
         tools=[reply_to_user, get_chat_history],
         instrument=True
     )
 
+    turn_queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+    recent_turns = RecentTurns()
     application.bot_data['engine'] = engine
+    application.bot_data['recent_turns'] = recent_turns
     application.bot_data['agent'] = agent
+    application.bot_data['turn_queue'] = turn_queue
+    application.bot_data['turn_writer'] = asyncio.create_task(_write_turns(engine, turn_queue, recent_turns))
     logger.info("Database and agent initialized successfully.")
 
 async def shutdown(application):
+    turn_writer = application.bot_data.get('turn_writer')
+    if _active_runs:
+        # PTB doesn't await every handler during stop(); let runs still going queue their turns first
+        _, pending = await asyncio.wait(set(_active_runs), timeout=SHUTDOWN_RUN_TIMEOUT)
+        if pending:
+            logger.warning(f"Shutting down with {len(pending)} message runs still in progress")
+    if turn_writer:
+        # The writer flushes turns still waiting in the queue, then exits on the sentinel
+        await application.bot_data['turn_queue'].put(None)
+        await turn_writer
     engine = application.bot_data.get('engine')
     if engine:
-        engine.dispose()
+        await engine.dispose()
         logger.info("Database connection closed.")
 
 def main() -> None:
-    app = Application.builder().token(BOT_TOKEN).post_init(startup).post_shutdown(shutdown).build()
+    if uvloop is not None:
+        # run_polling runs on the current event loop, so make that a libuv one
+        asyncio.set_event_loop(uvloop.new_event_loop())
+    app = (
+        Application.builder()
+        .token(settings.bot_token)
+        # Process updates concurrently so one slow agent run doesn't hold up every other chat;
+        # outbound calls share PTB's default 256-connection pool, so wait for a free slot instead of failing
+        .concurrent_updates(True)
+        .pool_timeout(30)
+        # Multiplex typing/reply calls over a few HTTP/2 connections instead of one TLS connection each
+        .http_version("2")
+        .post_init(startup)
+        .post_shutdown(shutdown)
+        .build()
+    )
     app.add_handlers([CommandHandler("start", start), MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler)])
     logger.info("Starting bot polling...")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
-    logger.info("Bot polling stopped.")
+    try:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
+        logger.info("Bot polling stopped.")
+    finally:
+        # Flush whatever is still queued before the process exits
+        log_listener.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
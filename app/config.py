@@ -0,0 +1,44 @@
+import os
+from dataclasses import dataclass, field
+
+from sqlalchemy.engine import make_url
+
+
+def _async_database_url(url: str) -> str:
+    """Point a plain postgresql:// URL (as Railway provides it) at the asyncpg driver."""
+    parsed = make_url(url)
+    if parsed.drivername not in ('postgres', 'postgresql'):
+        return url
+    query = dict(parsed.query)
+    # libpq spells it sslmode (psycopg2 accepted it); asyncpg takes the same values as ssl
+    if 'sslmode' in query:
+        query['ssl'] = query.pop('sslmode')
+    return parsed.set(drivername='postgresql+asyncpg', query=query).render_as_string(hide_password=False)
+
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    bot_token: str = field(repr=False)
+    model_identifier: str
+    database_url: str = field(repr=False)
+    allowed_chat_ids: frozenset[int]
+    create_tables: bool
+    db_pool_size: int
+    db_max_overflow: int
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        chat_ids_str = os.getenv('ALLOWED_CHAT_IDS', '')
+        return cls(
+            bot_token=os.environ['TELEGRAM_BOT_TOKEN'],
+            model_identifier=os.environ['MODEL_IDENTIFIER'],
+            database_url=_async_database_url(os.environ['DATABASE_URL']),
+            allowed_chat_ids=frozenset(map(int, filter(None, (x.strip() for x in chat_ids_str.strip('[]').split(','))))),
+            create_tables=os.getenv('CREATE_TABLES', 'true').lower() != 'false',
+            db_pool_size=int(os.getenv('DB_POOL_SIZE', '20')),
+            db_max_overflow=int(os.getenv('DB_MAX_OVERFLOW', '10')),
+        )
+
+
+# Read once at import; everything else reads from this object
+settings = Settings.from_env()
@@ -1,25 +1,42 @@
-from datetime import datetime
-from pydantic import BaseModel
+from dataclasses import dataclass, field
+from datetime import datetime, UTC
 from sqlmodel import SQLModel, Field
-from sqlalchemy import JSON
-from sqlalchemy.engine import Engine
+from sqlalchemy import JSON, BigInteger, DateTime, Index, text
+from sqlalchemy.dialects.postgresql import JSONB, to_tsvector
+from sqlalchemy.ext.asyncio import AsyncEngine
 from telegram import Message
 import asyncio
 
+from app.recent_turns import RecentTurns
+
 
 class ConversationTurn(SQLModel, table=True):
     __tablename__ = "conversation_turns"
+    # Per-chat time-window reads are range scans on (chat_id, timestamp)
+    __table_args__ = (Index("ix_conversation_turns_chat_id_timestamp", "chat_id", "timestamp"),)
     id: int | None = Field(default=None, primary_key=True)
-    chat_id: int = Field(index=True)
+    # Supergroup and newer user IDs don't fit in a 32-bit integer
+    chat_id: int = Field(sa_type=BigInteger)
     user_message: str
-    assistant_replies: list[str] = Field(default_factory=list, sa_type=JSON)
-    timestamp: datetime = Field(default_factory=datetime.now, index=True)
+    assistant_replies: list[str] = Field(default_factory=list, sa_type=JSON().with_variant(JSONB, "postgresql"))
+    timestamp: datetime = Field(default_factory=lambda: datetime.now(UTC), sa_type=DateTime(timezone=True), index=True)
+
+
+# Full-text search document for a turn (user message plus every reply string in the JSON array).
+# Queries must use this exact expression for Postgres to answer them from the GIN index.
+SEARCH_CONFIG = text("'english'::regconfig")
+turn_search_vector = to_tsvector(SEARCH_CONFIG, ConversationTurn.user_message).op('||')(
+    to_tsvector(SEARCH_CONFIG, ConversationTurn.assistant_replies)
+)
+Index("ix_conversation_turns_search", turn_search_vector, postgresql_using="gin").ddl_if(dialect="postgresql")
 
 
-class ChatDeps(BaseModel):
+@dataclass(slots=True)
+class ChatDeps:
     telegram_message: Message
-    engine: Engine
+    engine: AsyncEngine
+    recent_turns: RecentTurns
     assistant_replies: list[str]
-    typing_task: asyncio.Task | None = None
-    class Config:
-        arbitrary_types_allowed = True
\ No newline at end of file
+    typing_done: asyncio.Event = field(default_factory=asyncio.Event)
+    # get_chat_history results for this run, keyed on the tool arguments
+    history_cache: dict[tuple, list[dict]] = field(default_factory=dict)
\ No newline at end of file
@@ -0,0 +1,100 @@
+import bisect
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Iterable
+from dataclasses import dataclass
+from datetime import datetime
+from operator import itemgetter
+
+
+TURNS_PER_CHAT = 50
+MAX_CHATS = 1000
+
+_by_timestamp = itemgetter("timestamp")
+
+
+@dataclass(slots=True)
+class _ChatTurns:
+    rows: list[dict]  # oldest first
+    complete: bool  # rows hold every turn the chat has
+
+
+@dataclass(slots=True)
+class _Loading:
+    in_flight: int = 0
+    writes: int = 0  # turns committed for the chat since the first of these loads started
+
+
+class RecentTurns:
+    """Newest turns per chat, kept in step with the database by the turn writer.
+
+    Only chats that have been loaded once are tracked, least recently used chats are
+    evicted past MAX_CHATS, and `select` answers only windows it can answer exactly.
+    Row timestamps must be timezone-aware.
+    """
+
+    def __init__(self, per_chat: int = TURNS_PER_CHAT, max_chats: int = MAX_CHATS):
+        self.per_chat = per_chat
+        self.max_chats = max_chats
+        self._chats: OrderedDict[int, _ChatTurns] = OrderedDict()
+        # Only chats with a load in progress, so a load that raced a write can be discarded
+        self._loading: dict[int, _Loading] = {}
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self._chats
+
+    async def load(self, chat_id: int, fetch: Callable[[], Awaitable[list[dict]]]) -> None:
+        """Seed a chat with the newest rows (oldest first) returned by `fetch`."""
+        loading = self._loading.setdefault(chat_id, _Loading())
+        loading.in_flight += 1
+        writes = loading.writes
+        try:
+            rows = await fetch()
+        finally:
+            loading.in_flight -= 1
+            if not loading.in_flight:
+                del self._loading[chat_id]
+        if loading.writes != writes:
+            return
+        self._chats[chat_id] = _ChatTurns(rows, complete=len(rows) < self.per_chat)
+        self._chats.move_to_end(chat_id)
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+
+    def add(self, rows: list[dict]) -> None:
+        """Record committed rows for the chats being tracked."""
+        for row in rows:
+            chat_id = row["chat_id"]
+            if loading := self._loading.get(chat_id):
+                loading.writes += 1
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                continue
+            bisect.insort(chat.rows, row, key=_by_timestamp)
+            if len(chat.rows) > self.per_chat:
+                del chat.rows[0]
+                chat.complete = False
+
+    def forget(self, chat_ids: Iterable[int]) -> None:
+        """Stop tracking chats whose cached rows may no longer match the database."""
+        for chat_id in chat_ids:
+            self._chats.pop(chat_id, None)
+            if loading := self._loading.get(chat_id):
+                loading.writes += 1
+
+    def select(self, chat_id: int, window: slice, after: datetime | None) -> list[dict] | None:
+        """Rows in `window` of the chat's turns since `after`, or None if the cache can't tell."""
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            return None
+        self._chats.move_to_end(chat_id)
+        rows = chat.rows
+        if after is not None:
+            rows = rows[bisect.bisect_left(rows, after, key=_by_timestamp):]
+        # Every matching turn is cached if nothing was ever dropped or the cutoff falls inside the cache
+        if chat.complete or len(rows) < len(chat.rows):
+            return rows[window]
+        # Otherwise only windows counted back from the newest turn that fit in the cache
+        start, stop = window.start, window.stop
+        if start is not None and -len(rows) <= start < 0 and (stop is None or stop < 0):
+            return rows[window]
+        return None
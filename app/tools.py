@@ -1,18 +1,146 @@
-from datetime import datetime, timedelta
-from sqlmodel import Session, select
-from sqlalchemy import or_, func
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+from datetime import datetime, timedelta, UTC
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.dialects.postgresql import plainto_tsquery
+from sqlalchemy.ext.asyncio import AsyncEngine
 from pydantic_ai import RunContext
 from telegram.constants import ParseMode
 import telegramify_markdown
-from app.models import ConversationTurn, ChatDeps
+from app.models import ConversationTurn, ChatDeps, SEARCH_CONFIG, turn_search_vector
+from app.recent_turns import RecentTurns
+
+
+# mistletoe (behind telegramify_markdown) swaps its token registry in module globals while
+# rendering, so conversions must not overlap; a single worker serializes them
+_markdown_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="markdownify")
+
+
+def _parse_turns(turns: str) -> slice:
+    """Parse Python slice syntax ("-5:", "2:8", ":") or a single index ("-1") into a slice."""
+    if ':' not in turns:
+        idx = int(turns)
+        return slice(idx, idx + 1 or None)
+    parts = turns.split(':')
+    return slice(int(parts[0]) if parts[0] else None, int(parts[1]) if parts[1] else None)
+
+
+def _as_utc(value: datetime) -> datetime:
+    """Tables not yet migrated to timestamptz return naive values; read them as UTC."""
+    return value if value.tzinfo is not None else value.replace(tzinfo=UTC)
+
+
+async def _fetch_recent_turns(engine: AsyncEngine, chat_id: int, limit: int) -> list[dict]:
+    async with AsyncSession(engine) as session:
+        statement = (
+            select(ConversationTurn)
+            .where(ConversationTurn.chat_id == chat_id)
+            .order_by(ConversationTurn.timestamp.desc())
+            .limit(limit)
+        )
+        rows = (await session.exec(statement)).all()
+    return [
+        {
+            "chat_id": row.chat_id,
+            "user_message": row.user_message,
+            "assistant_replies": row.assistant_replies,
+            "timestamp": _as_utc(row.timestamp)
+        }
+        for row in reversed(rows)
+    ]
+
+
+async def _query_chat_history(
+    engine: AsyncEngine,
+    recent_turns: RecentTurns,
+    chat_id: int,
+    turns: str,
+    query: list[str] | None,
+    days: int | None
+) -> list[dict]:
+    try:
+        window = _parse_turns(turns) if turns else slice(None)
+    except ValueError:
+        # Invalid slice syntax, return empty list
+        return []
+    after_dt = datetime.now(UTC) - timedelta(days=days) if days is not None else None
+
+    if not query:
+        # Recency windows are usually answerable from the turns the writer keeps in memory
+        if chat_id not in recent_turns:
+            await recent_turns.load(chat_id, functools.partial(_fetch_recent_turns, engine, chat_id, recent_turns.per_chat))
+        cached = recent_turns.select(chat_id, window, after_dt)
+        if cached is not None:
+            return [
+                {
+                    "user_message": row["user_message"],
+                    "assistant_replies": row["assistant_replies"],
+                    "timestamp": row["timestamp"].isoformat()
+                }
+                for row in cached
+            ]
+
+    async with AsyncSession(engine) as session:
+        # Start with chat_id filter to match the current chat
+        statement = select(ConversationTurn).where(ConversationTurn.chat_id == chat_id)
+
+        # Apply time filter
+        if after_dt is not None:
+            statement = statement.where(ConversationTurn.timestamp >= after_dt)
+
+        if query:
+            # Match turns containing any of the terms: OR the per-term queries into one tsquery
+            terms = [plainto_tsquery(SEARCH_CONFIG, term) for term in query]
+            statement = statement.where(turn_search_vector.op('@@')(functools.reduce(lambda a, b: a.op('||')(b), terms)))
+
+        # Translate the slice into ORDER BY/OFFSET/LIMIT so only the selected rows are fetched
+        start, stop = window.start, window.stop
+        newest_first, python_slice = False, None
+        if (start is None or start >= 0) and (stop is None or stop >= 0):
+            # Counted from the oldest turn
+            statement = statement.order_by(ConversationTurn.timestamp.asc()).offset(start)
+            if stop is not None:
+                statement = statement.limit(max(stop - (start or 0), 0))
+        elif (start is None or start < 0) and (stop is None or stop < 0):
+            # Counted back from the newest turn: fetch newest-first, restore order afterwards
+            offset = -stop if stop is not None else 0
+            statement = statement.order_by(ConversationTurn.timestamp.desc()).offset(offset or None)
+            if start is not None:
+                statement = statement.limit(max(-start - offset, 0))
+            newest_first = True
+        else:
+            # Mixed-sign bounds depend on the row count, so slice in Python
+            statement = statement.order_by(ConversationTurn.timestamp.asc())
+            python_slice = window
+
+        # Execute query
+        result = await session.exec(statement)
+        rows = result.all()
+        if newest_first:
+            rows.reverse()
+        elif python_slice:
+            rows = rows[python_slice]
+
+        # Convert only the selected rows to dicts
+        return [
+            {
+                "user_message": row.user_message,
+                "assistant_replies": row.assistant_replies,
+                "timestamp": _as_utc(row.timestamp).isoformat()
+            }
+            for row in rows
+        ]
 
 
 async def reply_to_user(ctx: RunContext[ChatDeps], message: str) -> bool | Exception:
-    # Cancel typing indicator before sending reply
-    if ctx.deps.typing_task and not ctx.deps.typing_task.done():
-        ctx.deps.typing_task.cancel()
+    # Stop the typing indicator before sending reply
+    ctx.deps.typing_done.set()
 
-    await ctx.deps.telegram_message.reply_text(telegramify_markdown.markdownify(message), parse_mode=ParseMode.MARKDOWN_V2)
+    # Markdown conversion is CPU-bound (~4ms per KB), so keep it off the event loop
+    text = await asyncio.get_running_loop().run_in_executor(_markdown_executor, telegramify_markdown.markdownify, message)
+    await ctx.deps.telegram_message.reply_text(text, parse_mode=ParseMode.MARKDOWN_V2)
     ctx.deps.assistant_replies.append(message)
     return True
 
@@ -55,63 +183,10 @@ async def get_chat_history(
         # Get all messages (no time filter)
         get_chat_history(days=None)
     """
-    with Session(ctx.deps.engine) as session:
-        # Start with chat_id filter to match the current chat
-        statement = select(ConversationTurn).where(ConversationTurn.chat_id == ctx.deps.telegram_message.chat.id)
-
-        # Apply time filter
-        if days is not None:
-            after_dt = datetime.now() - timedelta(days=days)
-            statement = statement.where(ConversationTurn.timestamp >= after_dt)
-
-        if query:
-            # Create search conditions for each query term
-            search_conditions = []
-            for term in query:
-                term_condition = or_(
-                    func.to_tsvector('english', ConversationTurn.user_message).op('@@')(
-                        func.plainto_tsquery('english', term)
-                    ),
-                    func.to_tsvector('english', func.array_to_string(ConversationTurn.assistant_replies, ' ')).op('@@')(
-                        func.plainto_tsquery('english', term)
-                    )
-                )
-                search_conditions.append(term_condition)
-
-            # Combine all search conditions with OR (match any term)
-            statement = statement.where(or_(*search_conditions))
-
-        statement = statement.order_by(ConversationTurn.timestamp.asc())
-
-        # Execute query
-        result = session.exec(statement)
-        rows = result.all()
-
-        # Convert to list of dicts
-        conversation_turns = []
-        for row in rows:
-            turn = {
-                "user_message": row.user_message,
-                "assistant_replies": row.assistant_replies,
-                "timestamp": row.timestamp.isoformat()
-            }
-            conversation_turns.append(turn)
-
-        # Apply slice-based filtering
-        if turns:
-            try:
-                # Parse slice notation (e.g., "-5:", "2:8", ":")
-                if ':' in turns:
-                    parts = turns.split(':')
-                    start = int(parts[0]) if parts[0] else None
-                    end = int(parts[1]) if parts[1] else None
-                    conversation_turns = conversation_turns[start:end]
-                else:
-                    # Single index
-                    idx = int(turns)
-                    conversation_turns = [conversation_turns[idx]]
-            except (ValueError, IndexError):
-                # Invalid slice syntax, return empty list
-                conversation_turns = []
-
-        return conversation_turns
\ No newline at end of file
+    # Turns are saved after the run ends, so repeat calls within a run can reuse the first result
+    key = (turns, tuple(query) if query else None, days)
+    if key not in ctx.deps.history_cache:
+        ctx.deps.history_cache[key] = await _query_chat_history(
+            ctx.deps.engine, ctx.deps.recent_turns, ctx.deps.telegram_message.chat.id, turns, query, days
+        )
+    return ctx.deps.history_cache[key]